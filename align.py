@@ -1,4 +1,5 @@
 import numpy as np
+import midi
 
 
 def align_frame_to_frame(pattern, stride):
@@ -48,8 +49,118 @@ def align_frame_to_frame(pattern, stride):
         #repl = [ref_idx] * (cand_idx - len(align) + 1)
         align += list(repl.astype(int))
     return align
-        
-    
+
+
+def tempo_map(pattern, warp=None):
+    '''
+    Piecewise linear map from absolute ticks to seconds,
+    following SetTempoEvents as MidiPattern.stamp_time does.
+
+    Parameters
+    ----------
+    pattern : MidiPattern
+        *simplified* pattern
+    warp : distorter.TimeWarp, optional
+        if given, map of pattern warped by TimeWarpDistorter,
+        i.e. with every event moved to round(warp(tick))
+
+    Returns
+    -------
+    ticks : array of float
+        absolute tick at which each tempo starts
+    seconds : array of float
+        time in seconds of ticks
+    spt : array of float
+        seconds per tick from ticks onwards
+    '''
+    changes = []
+    for track in pattern:
+        tick = 0
+        for e in track:
+            tick = tick + e.tick if pattern.tick_relative else e.tick
+            if isinstance(e, midi.SetTempoEvent):
+                changes.append((tick, e.get_bpm()))
+    changes.sort(key=lambda change: change[0])
+    ticks = np.array([0.] + [tick for tick, _ in changes])
+    bpms = np.array([120.] + [bpm for _, bpm in changes])
+    if warp is not None:
+        ticks = np.round(warp(ticks))
+    spt = 60. / bpms / pattern.resolution
+    seconds = np.concatenate(([0.], np.cumsum(np.diff(ticks) * spt[:-1])))
+    return ticks, seconds, spt
+
+
+def ticks_to_seconds(tempo, ticks):
+    '''
+    Parameters
+    ----------
+    tempo : tuple
+        as returned by tempo_map()
+    ticks : array of float
+        absolute ticks
+    '''
+    starts, seconds, spt = tempo
+    k = np.searchsorted(starts, ticks, side='right') - 1
+    return seconds[k] + (ticks - starts[k]) * spt[k]
+
+
+def seconds_to_ticks(tempo, seconds):
+    '''
+    Inverse of ticks_to_seconds()
+    '''
+    starts, start_seconds, spt = tempo
+    k = np.searchsorted(start_seconds, seconds, side='right') - 1
+    return starts[k] + (seconds - start_seconds[k]) / spt[k]
+
+
+def align_from_warp(pattern, warp, stride):
+    '''
+    Exact alignment from a known time warp.
+
+    Candidate windows are mapped to warped ticks through the
+    warped tempo map, back through the warp, then to reference
+    seconds through the tempo map of pattern, so the alignment
+    agrees with the 't0' and 't' stamps of the distorted pattern.
+
+    Parameters
+    ----------
+    pattern : MidiPattern
+        reference pattern, i.e. the input of the TimeWarpDistorter
+        which produced warp; it must not have been distorted
+        in time already, since warp ignores earlier distortions
+    warp : distorter.TimeWarp
+        warp from pattern ticks to candidate ticks,
+        e.g. TimeWarpDistorter.warp
+    stride : float
+        stride of window in seconds
+
+    Returns
+    -------
+    align : list of float
+        reference time in seconds of the start
+        of each candidate window
+    '''
+    if 'attributes' in pattern.__dict__:
+        for track_attributes in pattern.attributes:
+            for e_attr in track_attributes:
+                if ('t' in e_attr and
+                        abs(e_attr['t'] - e_attr['t0']) > 1e-9):
+                    raise ValueError(
+                        'pattern was already distorted in time')
+    ref_tempo = tempo_map(pattern)
+    cand_tempo = tempo_map(pattern, warp)
+    length = 0
+    for track in pattern:
+        ticks = np.array([e.tick for e in track], dtype=float)
+        if len(ticks):
+            last = ticks.sum() if pattern.tick_relative else ticks.max()
+            length = max(length, last)
+    duration = ticks_to_seconds(cand_tempo, np.round(warp(length)))
+    cand = stride * np.arange(int(np.ceil(duration / stride)))
+    ref_ticks = warp.inverse(seconds_to_ticks(cand_tempo, cand))
+    return list(ticks_to_seconds(ref_tempo, ref_ticks))
+
+
 def write_align(fname, align, stride):
     '''
     Write alignment to file
@@ -9,6 +9,7 @@ need to rebuild attributes!!
 '''
 
 from abc import abstractmethod
+from collections import OrderedDict
 import numpy as np
 import midi
 from midipattern import MidiPattern
@@ -24,6 +25,10 @@ class Distorter(object):
     
     No need to preserve measures.
     '''
+    # Attributes set by _distort() rather than by the user,
+    # excluded from params() and restored on cache hits
+    outputs = ()
+
     def distort(self, pattern, keep_stamps=False):
         '''
         Distort a pattern.
@@ -89,6 +94,18 @@ class Distorter(object):
         '''
         pass
     
+    def params(self):
+        '''
+        Parameters of distorter, excluding outputs.
+        
+        Returns
+        -------
+        params : tuple of (str, object)
+            sorted (name, value) pairs
+        '''
+        return tuple(sorted((k, v) for k, v in self.__dict__.items()
+                            if k not in self.outputs))
+    
     def __repr__(self):
         name = self.__class__.__name__
         params = ['{}={}'.format(k,v) for k,v in self.__dict__.items()]
@@ -322,8 +339,189 @@ class TempoDistorter(Distorter):
                 tmp_tick = e.tick * multiple
                 e.tick = np.clip(int(tmp_tick), 1, 127)
         return new_pattern
-    
-    
+
+
+class TimeWarp(object):
+    '''
+    Continuous, strictly increasing warp of absolute ticks.
+
+    The local tempo multiple (warped ticks per original tick)
+    is piecewise linear between knots, so the warp itself
+    is a C1 piecewise quadratic spline that can be evaluated
+    and inverted exactly.
+    '''
+    def __init__(self, knots, rates):
+        '''
+        Parameters
+        ----------
+        knots : array of float
+            increasing absolute ticks, starting at 0
+        rates : array of float
+            positive tempo multiple at each knot,
+            held constant after the last knot
+        '''
+        self.knots = np.asarray(knots, dtype=float)
+        self.rates = np.asarray(rates, dtype=float)
+        widths = np.diff(self.knots)
+        self.slopes = np.diff(self.rates) / widths
+        # warped tick at each knot
+        self.values = np.concatenate(([0.], np.cumsum(
+            widths * (self.rates[:-1] + self.rates[1:]) / 2.)))
+
+    def __repr__(self):
+        return 'TimeWarp(knots={}, min={:.2f}, max={:.2f})'.format(
+            len(self.knots), self.rates.min(), self.rates.max())
+
+    def _segments(self, x, bounds):
+        # index of segment, extrapolating past the last knot
+        idx = np.searchsorted(bounds, x, side='right') - 1
+        return np.clip(idx, 0, len(bounds) - 1)
+
+    def __call__(self, ticks):
+        '''
+        Map original absolute ticks to warped absolute ticks.
+
+        Parameters
+        ----------
+        ticks : array of float
+            original absolute ticks
+
+        Returns
+        -------
+        warped : array of float
+        '''
+        x = np.asarray(ticks, dtype=float)
+        k = self._segments(x, self.knots)
+        d = x - self.knots[k]
+        slopes = np.append(self.slopes, 0.)[k]
+        return self.values[k] + self.rates[k] * d + slopes * d**2 / 2.
+
+    def inverse(self, warped):
+        '''
+        Map warped absolute ticks back to original absolute ticks.
+
+        Parameters
+        ----------
+        warped : array of float
+            warped absolute ticks
+
+        Returns
+        -------
+        ticks : array of float
+        '''
+        y = np.asarray(warped, dtype=float)
+        k = self._segments(y, self.values)
+        dy = y - self.values[k]
+        r = self.rates[k]
+        s = np.append(self.slopes, 0.)[k]
+        # root of s/2 d^2 + r d - dy = 0, stable when s == 0
+        d = 2. * dy / (r + np.sqrt(np.maximum(r**2 + 2. * s * dy, 0.)))
+        return self.knots[k] + d
+
+
+class TimeWarpDistorter(Distorter):
+    '''
+    Change tempo by warping absolute ticks with
+    a smooth random spline.
+
+    Unlike TempoDistorter, the warp is explicit:
+    after distort(), self.warp holds the exact TimeWarp
+    from the ticks of the input pattern to distorted ticks
+    (see align.align_from_warp). It is relative to the input of
+    this distorter, so it ignores earlier distortions in a chain.
+
+    This ignores SetTempoEvent and does not introduce additional ones.
+    '''
+    outputs = ('warp',)
+
+    def __init__(self, sigma=0.5, min=0.5, max=2., beats=4.):
+        '''
+        Parameters
+        ----------
+        sigma : float
+            standard deviation of log tempo multiple
+            per quarter note
+        min : float
+            minimum multiple of original tempo
+        max : float
+            maximum multiple of original tempo
+        beats : float
+            distance between spline knots in quarter notes
+        '''
+        self.sigma = sigma
+        self.min = min
+        self.max = max
+        self.beats = beats
+        self.warp = None
+
+    def __repr__(self):
+        return 'TimeWarpDistorter(sigma={:.2f}, min={:.2f}, max={:.2f}, beats={:.2f})'.format(self.sigma, self.min, self.max, self.beats)
+
+    def randomize(self, params=None):
+        '''
+        Parameters
+        ----------
+        params : dict
+            min_sigma, max_sigma : float
+                where self.sigma ~ U(min_sigma, max_sigma)
+            min, max : float
+                where self.min, self.max ~ U(min, max)
+                and min < max
+        '''
+        p = {'min_sigma': 0., 'max_sigma': 1.,
+             'min': 0.6, 'max': 1.5}
+        if params:
+            p.update(params)
+        self.sigma = np.random.uniform(p['min_sigma'], p['max_sigma'])
+        a, b = np.random.uniform(p['min'], p['max'], size=2)
+        self.min = min(a, b)
+        self.max = max(a, b)
+
+    def sample_warp(self, length, resolution):
+        '''
+        Sample a random TimeWarp covering [0, length] ticks.
+
+        Parameters
+        ----------
+        length : int
+            last absolute tick to cover
+        resolution : int
+            ticks per quarter note
+
+        Returns
+        -------
+        warp : TimeWarp
+        '''
+        step = self.beats * resolution
+        n_knots = int(np.ceil(max(length, 1) / step)) + 1
+        knots = step * np.arange(n_knots)
+        # bounded random walk on log multiple, starting at original tempo
+        log_min, log_max = np.log(self.min), np.log(self.max)
+        log_rates = np.zeros(n_knots)
+        log_rate = np.clip(0., log_min, log_max)
+        for i in xrange(n_knots):
+            log_rates[i] = log_rate
+            log_rate = np.clip(log_rate + self.sigma * np.sqrt(self.beats)
+                               * np.random.normal(), log_min, log_max)
+        return TimeWarp(knots, np.exp(log_rates))
+
+    def _distort(self, pattern, new_pattern):
+        new_pattern.make_ticks_abs()
+        ticks = [e.tick for track in new_pattern for e in track]
+        if not ticks:
+            self.warp = self.sample_warp(0, pattern.resolution)
+            new_pattern.make_ticks_rel()
+            return new_pattern
+        length = max(ticks)
+        self.warp = self.sample_warp(length, pattern.resolution)
+        for track in new_pattern:
+            ticks = self.warp([e.tick for e in track])
+            # rounding a monotonic warp preserves event order
+            for e, tick in zip(track, np.round(ticks).astype(int)):
+                e.tick = int(tick)
+        new_pattern.make_ticks_rel()
+        return new_pattern
+
 
 class TimeNoiseDistorter(Distorter):
     '''
@@ -376,7 +574,109 @@ class TimeNoiseDistorter(Distorter):
         return new_pattern
 
 
-def random_distort(pattern, distorters=None):
+class DistortionCache(object):
+    '''
+    LRU cache of intermediate patterns of distortion chains.
+    
+    Entries are keyed on the key of their input
+    (ultimately the source pattern digest), the distorter class,
+    its parameters and its seed, so chains sharing a prefix
+    only recompute the differing suffix.
+    Memory is bounded by the total number of cached events.
+    '''
+    def __init__(self, max_events=1000000):
+        '''
+        Parameters
+        ----------
+        max_events : int
+            maximum total number of events over cached patterns
+        '''
+        self.max_events = max_events
+        self.entries = OrderedDict()
+        self.events = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def __repr__(self):
+        return 'DistortionCache(entries={}, events={}, hits={}, misses={}, evictions={})'.format(
+            len(self.entries), self.events, self.hits,
+            self.misses, self.evictions)
+    
+    def __len__(self):
+        return len(self.entries)
+        
+    def key(self, parent, distorter, seed, keep_stamps):
+        '''
+        Key of the output of distorter applied to the entry parent.
+        
+        Parameters
+        ----------
+        parent : tuple or str
+            key of input, or digest of source pattern
+        distorter : Distorter
+            distorter to apply
+        seed : int
+            seed of numpy random generator before distortion
+        keep_stamps : bool
+            passed to Distorter.distort
+        '''
+        return (parent, distorter.__class__.__name__,
+                repr(distorter.params()), seed, keep_stamps)
+    
+    def get(self, key):
+        '''
+        Returns
+        -------
+        entry : (MidiPattern, dict) or None
+            cached pattern and distorter outputs, None on miss
+        '''
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = entry  # most recently used
+        return entry
+    
+    def put(self, key, pattern, outputs):
+        '''
+        Cache pattern and distorter outputs, evicting
+        least recently used entries as needed.
+        '''
+        if key in self.entries:
+            self.events -= self._size(self.entries.pop(key)[0])
+        size = self._size(pattern)
+        if size > self.max_events:
+            return
+        while self.events + size > self.max_events:
+            _, (old, _) = self.entries.popitem(last=False)
+            self.events -= self._size(old)
+            self.evictions += 1
+        self.entries[key] = (pattern, outputs)
+        self.events += size
+        
+    def clear(self):
+        self.entries.clear()
+        self.events = 0
+        
+    def stats(self):
+        '''
+        Returns
+        -------
+        stats : dict
+            hits, misses, evictions, entries, events
+        '''
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries), 'events': self.events}
+    
+    @staticmethod
+    def _size(pattern):
+        return sum(len(track) for track in pattern)
+
+
+def random_distort(pattern, distorters=None, seed=None, cache=None):
     '''
     Distort a simple pattern by applying a chain
     for distortions on it.
@@ -387,14 +687,43 @@ def random_distort(pattern, distorters=None):
         pattern to distort
     distorters : list of Distorter
         distorters to apply
+    seed : int, optional
+        if given, seed numpy random generator before each distortion
+        (this resets the global numpy random state)
+    cache : DistortionCache, optional
+        reuse intermediate patterns of previous chains,
+        requires seed
     '''
+    if cache is not None and seed is None:
+        raise ValueError('caching distortions requires a seed')
     if not distorters:
+        if seed is not None:
+            np.random.seed(seed)
         distorters = [TempoDistorter(), TimeNoiseDistorter()]
         for distorter in distorters:
             distorter.randomize()
+    seeds = [None] * len(distorters)
+    if seed is not None:
+        seeds = np.random.RandomState(seed).randint(
+            2**31 - 1, size=len(distorters))
+    key = pattern.digest() if cache is not None else None
     current = pattern
     for i, distorter in enumerate(distorters):
         keep_stamps = i > 0
+        if cache is not None:
+            key = cache.key(key, distorter, seeds[i], keep_stamps)
+            entry = cache.get(key)
+            if entry is not None:
+                current, outputs = entry
+                distorter.__dict__.update(outputs)
+                continue
+        if seeds[i] is not None:
+            np.random.seed(seeds[i])
         current = distorter.distort(current, keep_stamps)
+        if cache is not None:
+            cache.put(key, current, dict((k, getattr(distorter, k))
+                                         for k in distorter.outputs))
+    if cache is not None:
+        # cached patterns must not be modified by the caller
+        current = MidiPattern(current)
     return current
-
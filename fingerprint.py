@@ -0,0 +1,386 @@
+'''
+Locate a clip within a corpus of pieces.
+
+Landmarks are (time, pitch) onsets, either from the notes of
+a MidiPattern or from spectral peaks of audio.
+Triplets of nearby landmarks are hashed (constellation hashes)
+on their pitches and the ratio of their time differences,
+which does not depend on tempo, and stored in a sorted index,
+so that a query costs one binary search per query hash.
+Matching hashes vote for a (piece, tempo, offset) triple.
+'''
+
+import numpy as np
+import midi
+from midipattern import MidiPattern
+
+
+def note_landmarks(pattern, bpm=None):
+    '''
+    Onsets of notes of a pattern.
+
+    Parameters
+    ----------
+    pattern : MidiPattern
+        *simplified* pattern
+    bpm : float, optional
+        if given, override all bpm changes
+
+    Returns
+    -------
+    landmarks : array of float, shape (n, 2)
+        (time in seconds, pitch) sorted by time
+    '''
+    tmp = MidiPattern(pattern)
+    tmp.init_attributes()
+    tmp.stamp_time('t', bpm)
+    landmarks = [(e_attr['t'], e.get_pitch())
+                 for track, track_attributes in zip(tmp, tmp.attributes)
+                 for e, e_attr in zip(track, track_attributes)
+                 if (isinstance(e, midi.NoteOnEvent) and
+                     e.get_velocity() > 0)]
+    landmarks = np.array(sorted(landmarks), dtype=float)
+    return landmarks.reshape(-1, 2)
+
+
+def audio_landmarks(samples, rate, n_fft=4096, hop=512, peaks=5):
+    '''
+    Onsets of spectral peaks of audio, as MIDI pitches.
+
+    Peaks that were already present in the previous frame
+    are dropped, so sustained notes only count once.
+
+    Parameters
+    ----------
+    samples : array of float
+        mono audio
+    rate : int
+        sample rate in Hz
+    n_fft : int
+        window size in samples
+    hop : int
+        stride of window in samples
+    peaks : int
+        number of peaks kept per frame
+
+    Returns
+    -------
+    landmarks : array of float, shape (n, 2)
+        (time in seconds, pitch) sorted by time
+    '''
+    samples = np.asarray(samples, dtype=float)
+    n_frames = max(0, 1 + (len(samples) - n_fft) // hop)
+    if n_frames == 0:
+        return np.zeros((0, 2))
+    frames = np.lib.stride_tricks.as_strided(
+        samples, shape=(n_frames, n_fft),
+        strides=(samples.strides[0] * hop, samples.strides[0]))
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(n_fft), axis=1))
+    freqs = np.fft.rfftfreq(n_fft, 1. / rate)
+    # fold bins onto MIDI pitches
+    valid = (freqs > 0)
+    pitch = np.round(69 + 12 * np.log2(freqs[valid] / 440.)).astype(int)
+    valid[valid] = (pitch >= 0) & (pitch < 128)
+    pitch = pitch[(pitch >= 0) & (pitch < 128)]
+    spectrum = spectrum[:, valid]
+    energy = np.zeros((n_frames, 128))
+    for p in np.unique(pitch):
+        energy[:, p] = spectrum[:, pitch == p].max(axis=1)
+    # strongest pitches above frame mean
+    top = np.argsort(energy, axis=1)[:, -peaks:]
+    active = np.zeros((n_frames, 128), dtype=bool)
+    rows = np.arange(n_frames)[:, None]
+    active[rows, top] = (energy[rows, top] >
+                         energy.mean(axis=1, keepdims=True))
+    onsets = active.copy()
+    onsets[1:] &= ~active[:-1]
+    frame_idx, pitches = np.nonzero(onsets)
+    times = frame_idx * hop / float(rate)
+    return np.column_stack((times, pitches)).astype(float)
+
+
+class FingerprintIndex(object):
+    '''
+    Index of constellation hashes over a corpus.
+
+    Each hash packs the pitches of three landmarks and the quantized
+    ratio of their first time difference to their span into 27 bits,
+    and is stored along with its piece, anchor time and span
+    in arrays sorted by hash.
+    '''
+    PITCH_BITS = 7
+    RATIO_BITS = 6
+    MAX_PIECES = 2**32
+
+    def __init__(self, fan_out=5, time_step=0.05, rate_step=0.05):
+        '''
+        Parameters
+        ----------
+        fan_out : int
+            number of landmarks paired with each landmark,
+            among those at later onsets
+        time_step : float
+            quantization of onsets and offsets, in seconds;
+            closer landmarks are simultaneous
+        rate_step : float
+            quantization of log tempo ratio between clip and piece
+        '''
+        self.fan_out = fan_out
+        self.time_step = time_step
+        self.rate_step = rate_step
+        self.names = []
+        self.hashes = np.zeros(0, dtype=np.uint32)
+        self.pieces = np.zeros(0, dtype=np.uint32)
+        self.times = np.zeros(0, dtype=np.float32)
+        self.spans = np.zeros(0, dtype=np.float32)
+        self._pending = []
+
+    def __repr__(self):
+        return 'FingerprintIndex(pieces={}, hashes={})'.format(
+            len(self.names), len(self.hashes) +
+            sum(len(h) for _, h, _, _ in self._pending))
+
+    def __len__(self):
+        return len(self.names)
+
+    def landmark_hashes(self, landmarks):
+        '''
+        Constellation hashes of landmarks.
+
+        Landmark i is paired with the fan_out landmarks j
+        following its onset, and each j with the fan_out
+        landmarks k following its onset.
+        Hashes are unchanged by a change of tempo.
+
+        Parameters
+        ----------
+        landmarks : array of float, shape (n, 2)
+            (time in seconds, pitch) sorted by time
+
+        Returns
+        -------
+        hashes : array of uint32
+        times : array of float
+            time of landmark i of each hash, in seconds
+        spans : array of float
+            time from landmark i to landmark k, in seconds
+        '''
+        landmarks = np.asarray(landmarks, dtype=float).reshape(-1, 2)
+        t = landmarks[:, 0]
+        steps = np.round(t / self.time_step).astype(int)
+        pitches = np.clip(landmarks[:, 1], 0, 127).astype(np.uint32)
+        n = len(t)
+        # first landmark at a later onset, n if none
+        following = np.append(np.searchsorted(steps, steps, side='right'), n)
+        n_bins = 2**self.RATIO_BITS
+        hashes, times, spans = [], [], []
+        for a in xrange(self.fan_out):
+            j = following[:n] + a
+            i = np.nonzero(j < n)[0]
+            j = j[i]
+            for b in xrange(self.fan_out):
+                k = following[j] + b
+                keep = k < n
+                ii, jj, kk = i[keep], j[keep], k[keep]
+                span = t[kk] - t[ii]
+                ratio = np.minimum(
+                    ((t[jj] - t[ii]) / span * n_bins).astype(np.uint32),
+                    n_bins - 1)
+                hashes.append(
+                    (pitches[ii] << (2 * self.PITCH_BITS + self.RATIO_BITS)) |
+                    (pitches[jj] << (self.PITCH_BITS + self.RATIO_BITS)) |
+                    (pitches[kk] << self.RATIO_BITS) | ratio)
+                times.append(t[ii])
+                spans.append(span)
+        if not hashes:
+            return (np.zeros(0, dtype=np.uint32), np.zeros(0), np.zeros(0))
+        return (np.concatenate(hashes).astype(np.uint32),
+                np.concatenate(times), np.concatenate(spans))
+
+    def add(self, name, landmarks):
+        '''
+        Add a piece to the index.
+
+        Parameters
+        ----------
+        name : str
+            name of piece, returned by query()
+        landmarks : array of float, shape (n, 2)
+            see note_landmarks() and audio_landmarks()
+        '''
+        if len(self.names) >= self.MAX_PIECES:
+            raise ValueError('index is full ({} pieces)'.format(
+                self.MAX_PIECES))
+        hashes, times, spans = self.landmark_hashes(landmarks)
+        self._pending.append((len(self.names), hashes, times, spans))
+        self.names.append(name)
+
+    def build(self):
+        '''
+        Merge pieces added since last build into the sorted arrays.
+        '''
+        if not self._pending:
+            return
+        pieces, hashes, times, spans = zip(*self._pending)
+        pieces = [np.full(len(h), p, dtype=np.uint32)
+                  for p, h in zip(pieces, hashes)]
+        hashes = np.concatenate((self.hashes,) + hashes)
+        pieces = np.concatenate([self.pieces] + pieces)
+        times = np.concatenate((self.times,) + times)
+        spans = np.concatenate((self.spans,) + spans)
+        order = np.argsort(hashes, kind='mergesort')
+        self.hashes = hashes[order].astype(np.uint32)
+        self.pieces = pieces[order].astype(np.uint32)
+        self.times = times[order].astype(np.float32)
+        self.spans = spans[order].astype(np.float32)
+        self._pending = []
+
+    def query(self, landmarks, top=5):
+        '''
+        Find pieces, tempos and offsets matching a clip.
+
+        Matches first vote for a (piece, tempo ratio) pair, using the
+        ratio of the spans of matching hashes. For each of the best
+        pairs, they then vote for the offset of the clip, and several
+        offset peaks are kept, so that every occurrence of a repeated
+        passage is a candidate.
+        Votes are shared with neighbouring bins, and each match
+        counts towards a single candidate.
+
+        Parameters
+        ----------
+        landmarks : array of float, shape (n, 2)
+            landmarks of the clip, times relative to its start
+        top : int
+            maximum number of candidates
+
+        Returns
+        -------
+        candidates : list of (str, float, float, int)
+            (piece name, offset of clip start in seconds,
+            seconds of piece per second of clip, votes)
+            sorted by decreasing votes
+        '''
+        self.build()
+        hashes, times, spans = self.landmark_hashes(landmarks)
+        # tolerate one ratio bin on either side
+        mask = 2**self.RATIO_BITS - 1
+        hashes = hashes.astype(np.int64)
+        ratio = hashes & mask
+        near = [hashes, hashes - 1, hashes + 1]
+        valid = np.concatenate([ratio >= 0, ratio > 0, ratio < mask])
+        hashes = np.concatenate(near)[valid]
+        times = np.tile(times, 3)[valid]
+        spans = np.tile(spans, 3)[valid]
+
+        lo = np.searchsorted(self.hashes, hashes, side='left')
+        hi = np.searchsorted(self.hashes, hashes, side='right')
+        counts = hi - lo
+        total = counts.sum()
+        if total == 0:
+            return []
+        # flat indices of all matches, grouped by query hash
+        starts = np.cumsum(counts) - counts
+        idx = np.repeat(lo - starts, counts) + np.arange(total)
+        query_idx = np.repeat(np.arange(len(hashes)), counts)
+        pieces = self.pieces[idx].astype(np.int64)
+        ref_times = self.times[idx].astype(float)
+        rates = self.spans[idx] / spans[query_idx]
+        rate_bins = np.round(np.log(rates) / self.rate_step).astype(np.int64)
+
+        keys, votes = _votes(pieces, rate_bins)
+        candidates = []
+        chosen = []
+        # each match goes to the first chosen tempo bin it is near
+        free = np.ones(len(pieces), dtype=bool)
+        for best in np.argsort(-votes, kind='mergesort'):
+            if len(chosen) == top:
+                break
+            piece, rate_bin = keys[best] >> 32, (keys[best] & 0xffffffff) - 2**31
+            if any(piece == p and abs(rate_bin - r) <= 1 for p, r in chosen):
+                continue
+            chosen.append((piece, rate_bin))
+            sel = free & (pieces == piece) & (np.abs(rate_bins - rate_bin) <= 1)
+            free &= ~sel
+            sel = np.nonzero(sel)[0]
+            if not len(sel):
+                continue
+            rate = np.median(rates[sel])
+            offsets = ref_times[sel] - rate * times[query_idx[sel]]
+            offset_bins = np.round(offsets / self.time_step).astype(np.int64)
+            offset_keys, offset_votes = _votes(
+                np.zeros_like(offset_bins), offset_bins)
+            # several offset peaks, e.g. for repeated passages
+            peaks = []
+            unclaimed = np.ones(len(sel), dtype=bool)
+            for peak in np.argsort(-offset_votes, kind='mergesort'):
+                if len(peaks) == top:
+                    break
+                offset_bin = (offset_keys[peak] & 0xffffffff) - 2**31
+                if any(abs(offset_bin - o) <= 1 for o in peaks):
+                    continue
+                peaks.append(offset_bin)
+                near = unclaimed & (np.abs(offset_bins - offset_bin) <= 1)
+                unclaimed &= ~near
+                candidates.append((self.names[piece],
+                                   float(np.median(offsets[near])),
+                                   float(np.median(rates[sel[near]])),
+                                   int(near.sum())))
+        candidates.sort(key=lambda candidate: -candidate[3])
+        unique = set()
+        results = []
+        for name, offset, rate, vote in candidates:
+            key = (name, int(round(offset / self.time_step)),
+                   int(round(np.log(rate) / self.rate_step)))
+            if key not in unique:
+                unique.add(key)
+                results.append((name, offset, rate, vote))
+        return results[:top]
+
+    def save(self, fname):
+        '''
+        Write index to compressed .npz file
+        '''
+        self.build()
+        np.savez_compressed(
+            fname, hashes=self.hashes, pieces=self.pieces,
+            times=self.times, spans=self.spans,
+            names=np.array(self.names),
+            params=np.array([self.fan_out, self.time_step,
+                             self.rate_step]))
+
+    @classmethod
+    def load(cls, fname):
+        '''
+        Read index written by save()
+        '''
+        with np.load(fname) as data:
+            fan_out, time_step, rate_step = data['params']
+            index = cls(int(fan_out), float(time_step), float(rate_step))
+            index.names = [str(name) for name in data['names']]
+            index.hashes = data['hashes']
+            index.pieces = data['pieces']
+            index.times = data['times']
+            index.spans = data['spans']
+        return index
+
+
+def _votes(groups, bins):
+    '''
+    Count votes per (group, bin), shared with the neighbouring bins.
+
+    Returns
+    -------
+    keys : array of int64
+        sorted unique group << 32 | (bin + 2**31)
+    votes : array of int
+        votes of each key and of its two neighbouring bins
+    '''
+    keys = (groups << 32) | (bins + 2**31)
+    keys, counts = np.unique(keys, return_counts=True)
+    votes = counts.copy()
+    for delta in (-1, 1):
+        pos = np.searchsorted(keys, keys + delta)
+        pos = np.minimum(pos, len(keys) - 1)
+        votes += np.where(keys[pos] == keys + delta, counts[pos], 0)
+    return keys, votes
@@ -1,5 +1,6 @@
 import time
 import copy
+import hashlib
 from abc import abstractmethod
 
 # Midi file parser
@@ -107,6 +108,26 @@ class MidiPattern(midi.Pattern):
                 if (isinstance(e, midi.SetTempoEvent) and not fixed_bpm):
                     bpm = e.get_bpm()
                     
+    def digest(self):
+        '''
+        Hash of events and attributes, e.g. to key caches
+        
+        Returns
+        -------
+        digest : str
+            hex SHA-1 of resolution, ticks, events and attributes
+        '''
+        h = hashlib.sha1()
+        h.update('{} {} {}'.format(self.resolution, self.format,
+                                   self.tick_relative))
+        for track in self:
+            h.update('|')
+            for e in track:
+                h.update('{} {} {};'.format(
+                    e.__class__.__name__, e.tick, e.data))
+        h.update(repr(self.__dict__.get('attributes')))
+        return h.hexdigest()
+        
     def sort_all(self):
         '''
         Jointly sort events and attributes, in-place